@@ -1,31 +1,114 @@
-from datetime import datetime
+from datetime import datetime, timedelta
 from typing import Optional, List
-from sqlalchemy import select, and_, or_, desc
+from sqlalchemy import select, insert, and_, or_, desc, lambda_stmt, func, case
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.ext.asyncio import AsyncSession
 from app import models, schemas
+from app.models import utcnow
+from app.config import DATABASE_URL
+
+# obs_stats upkeep uses SQLite's upsert and scalar min()/max(); on other
+# backends it is skipped and history queries go straight to observations
+OBS_STATS = DATABASE_URL.startswith("sqlite")
+
+EPOCH       = datetime(1970, 1, 1)
+MICROSECOND = timedelta(microseconds=1)
+BIN_US      = 86400 * 1_000_000
+
+def epoch(dt: Optional[datetime]) -> Optional[int]:
+    # exact integer microseconds (floor division keeps pre-1970 values right)
+    return None if dt is None else (dt - EPOCH) // MICROSECOND
+
+def temporal_cols(start: datetime, end: Optional[datetime]) -> dict:
+    # integer VALID interval + day bin stored alongside the DATETIME columns
+    s = epoch(start)
+    return dict(
+        valid_start_epoch = s,
+        valid_end_epoch   = epoch(end),
+        bin_id            = s // BIN_US
+    )
+
+async def update_obs_stats(db: AsyncSession, rows: List[dict]) -> None:
+    # widen the (patient, LOINC) VALID bounds; an open valid_end stays NULL
+    if not OBS_STATS: return
+    st   = models.ObsStats
+    stmt = sqlite_insert(st)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[st.patient_id, st.loinc_num],
+        set_=dict(
+            min_valid_start_epoch = func.min(st.min_valid_start_epoch,
+                                             stmt.excluded.min_valid_start_epoch),
+            max_valid_end_epoch   = case(
+                (or_(st.max_valid_end_epoch == None,
+                     stmt.excluded.max_valid_end_epoch == None), None),
+                else_=func.max(st.max_valid_end_epoch,
+                               stmt.excluded.max_valid_end_epoch)
+            )
+        )
+    )
+    await db.execute(stmt, [dict(
+        patient_id            = r["patient_id"],
+        loinc_num             = r["loinc_num"],
+        min_valid_start_epoch = r["valid_start_epoch"],
+        max_valid_end_epoch   = r["valid_end_epoch"]
+    ) for r in rows])
 
 async def create_patient(db: AsyncSession, data: schemas.PatientCreate) -> models.Patient:
     p = models.Patient(**data.dict())
     db.add(p)
     await db.commit()
-    await db.refresh(p)
     return p
 
-async def create_observation(db: AsyncSession, data: schemas.ObservationCreate) -> models.Observation:
+async def create_observation(db: AsyncSession, data: schemas.ObservationCreate, now: Optional[datetime] = None) -> models.Observation:
+    now = now or utcnow()
     o = models.Observation(
         patient_id  = data.patient_id,
         loinc_num   = data.loinc_num,
         value_num   = data.value_num,
         valid_start = data.start,
         valid_end   = data.end,
-        txn_start   = datetime.utcnow(),
-        txn_end     = None
+        txn_start   = now,
+        txn_end     = None,
+        **temporal_cols(data.start, data.end)
     )
     db.add(o)
+    await update_obs_stats(db, [dict(
+        patient_id        = o.patient_id,
+        loinc_num         = o.loinc_num,
+        valid_start_epoch = o.valid_start_epoch,
+        valid_end_epoch   = o.valid_end_epoch
+    )])
     await db.commit()
-    await db.refresh(o)
     return o
 
+async def create_patients(db: AsyncSession, items: List[schemas.PatientCreate], commit: bool = True) -> List[models.Patient]:
+    # one executemany INSERT ... RETURNING, rows come back in input order
+    if not items: return []
+    stmt = insert(models.Patient).returning(models.Patient, sort_by_parameter_order=True)
+    ps = (await db.scalars(stmt, [i.dict() for i in items])).all()
+    if commit: await db.commit()
+    return ps
+
+async def create_observations(db: AsyncSession, items: List[schemas.ObservationCreate], commit: bool = True, now: Optional[datetime] = None) -> List[int]:
+    if not items: return []
+    now  = now or utcnow()
+    rows = [dict(
+        patient_id  = i.patient_id,
+        loinc_num   = i.loinc_num,
+        value_num   = i.value_num,
+        valid_start = i.start,
+        valid_end   = i.end,
+        txn_start   = now,
+        txn_end     = None,
+        **temporal_cols(i.start, i.end)
+    ) for i in items]
+    # only the ids: SQLite's RETURNING hands back integral REALs as ints
+    stmt = insert(models.Observation).returning(models.Observation.obs_id, sort_by_parameter_order=True)
+    ids  = (await db.scalars(stmt, rows)).all()
+    await update_obs_stats(db, rows)
+    if commit: await db.commit()
+    return ids
+
 async def observations_history(
     db: AsyncSession,
     patient_id: int,
@@ -33,29 +116,57 @@ async def observations_history(
     since: datetime,
     until: datetime
 ) -> List[models.Observation]:
-    stmt = (
+    # integer comparisons on the epoch columns; bin_id <= bin_e bounds the
+    # index range (no lower bin bound: a row starting before `since` can
+    # still overlap the window through its valid_end)
+    since_e = epoch(since)
+    until_e = epoch(until)
+    bin_e   = until_e // BIN_US
+
+    # prune via obs_stats: skip the observations table when the pair has
+    # no rows or its VALID bounds miss [since, until]; plain columns, so the
+    # identity map cannot hand back stale bounds
+    if OBS_STATS:
+        bounds = (await db.execute(lambda_stmt(lambda:
+            select(models.ObsStats.min_valid_start_epoch,
+                   models.ObsStats.max_valid_end_epoch)
+            .where(models.ObsStats.patient_id == patient_id)
+            .where(models.ObsStats.loinc_num  == loinc)
+        ))).first()
+        if bounds is None: return []
+        lo, hi = bounds
+        if lo > until_e or (hi is not None and hi < since_e): return []
+
+    # lambda_stmt caches the statement construction + compiled SQL;
+    # the closure variables become bound parameters on each call
+    stmt = lambda_stmt(lambda:
         select(models.Observation)
         .where(models.Observation.patient_id == patient_id)
         .where(models.Observation.loinc_num    == loinc)
         .where(models.Observation.txn_end      == None)
-        .where(models.Observation.valid_start <= until)
+        .where(models.Observation.bin_id      <= bin_e)
+        .where(models.Observation.valid_start_epoch <= until_e)
         .where(or_(
-            models.Observation.valid_end == None,
-            models.Observation.valid_end >= since
+            models.Observation.valid_end_epoch == None,
+            models.Observation.valid_end_epoch >= since_e
         ))
-        .order_by(models.Observation.valid_start)
+        # same order as valid_start (bin_id is its day), but matches ix_obs_bin
+        .order_by(models.Observation.bin_id, models.Observation.valid_start_epoch)
     )
     return (await db.scalars(stmt)).all()
 
 async def update_observation_value(
     db: AsyncSession,
     obs_id: int,
-    new_value: float
+    new_value: float,
+    now: Optional[datetime] = None
 ) -> Optional[models.Observation]:
     old = await db.get(models.Observation, obs_id)
     if not old:
         return None
-    old.txn_end = datetime.utcnow()
+    # one timestamp closes the old TXN interval and opens the new one
+    now = now or utcnow()
+    old.txn_end = now
     await db.commit()
 
     new = models.Observation(
@@ -64,12 +175,14 @@ async def update_observation_value(
         value_num   = new_value,
         valid_start = old.valid_start,
         valid_end   = old.valid_end,
-        txn_start   = datetime.utcnow(),
-        txn_end     = None
+        txn_start   = now,
+        txn_end     = None,
+        valid_start_epoch = old.valid_start_epoch,
+        valid_end_epoch   = old.valid_end_epoch,
+        bin_id            = old.bin_id
     )
     db.add(new)
     await db.commit()
-    await db.refresh(new)
     return new
 
 async def retroactive_update(
@@ -81,21 +194,21 @@ async def retroactive_update(
     new_value: float
 ) -> List[models.Observation]:
     first, last = patient_name.split(maxsplit=1)
-    p = (await db.scalars(
-            select(models.Patient)
-            .where(and_(models.Patient.first_name==first,
-                        models.Patient.last_name ==last))
-         )).first()
-    if not p: return []
-
-    old = (await db.scalars(
+    # patient lookup folded in as a scalar subquery (one round-trip); it is
+    # evaluated once, so patient_id stays a constant for the index search
+    old = (await db.scalars(lambda_stmt(lambda:
             select(models.Observation)
-            .where(models.Observation.patient_id==p.patient_id)
+            .where(models.Observation.patient_id == (
+                select(models.Patient.patient_id)
+                .where(and_(models.Patient.first_name==first,
+                            models.Patient.last_name ==last))
+                .limit(1)
+                .scalar_subquery()))
             .where(models.Observation.loinc_num   == loinc_code)
             .where(models.Observation.valid_start == measured_at)
             .order_by(desc(models.Observation.txn_start))
             .limit(1)
-    )).first()
+    ))).first()
     if not old: return []
 
     old.txn_end = txn_at
@@ -108,11 +221,13 @@ async def retroactive_update(
         valid_start = old.valid_start,
         valid_end   = old.valid_end,
         txn_start   = txn_at,
-        txn_end     = None
+        txn_end     = None,
+        valid_start_epoch = old.valid_start_epoch,
+        valid_end_epoch   = old.valid_end_epoch,
+        bin_id            = old.bin_id
     )
     db.add(new)
     await db.commit()
-    await db.refresh(new)
     return [old, new]
 
 async def retroactive_delete(
@@ -123,34 +238,46 @@ async def retroactive_delete(
     measured_at: Optional[datetime] = None
 ) -> List[models.Observation]:
     first, last = patient_name.split(maxsplit=1)
-    p = (await db.scalars(
-            select(models.Patient)
-            .where(and_(models.Patient.first_name==first,
-                        models.Patient.last_name ==last))
-         )).first()
-    if not p: return []
-
-    base = select(models.Observation).where(
-        models.Observation.patient_id==p.patient_id,
-        models.Observation.loinc_num   == loinc_code,
-        models.Observation.txn_end     == None
+    # patient lookup folded in as a scalar subquery (see retroactive_update)
+    base = lambda_stmt(lambda:
+        select(models.Observation)
+        .where(
+            models.Observation.patient_id == (
+                select(models.Patient.patient_id)
+                .where(and_(models.Patient.first_name==first,
+                            models.Patient.last_name ==last))
+                .limit(1)
+                .scalar_subquery()),
+            models.Observation.loinc_num == loinc_code,
+            models.Observation.txn_end   == None
+        )
     )
     if measured_at is not None:
-        base = base.where(models.Observation.valid_start == measured_at)
+        base += lambda s: s.where(models.Observation.valid_start == measured_at)
     else:
+        # half-open day [day_start, day_end)
         day_start = datetime.combine(delete_at.date(), datetime.min.time())
-        day_end   = datetime.combine(delete_at.date(), datetime.max.time())
-        base = base.where(models.Observation.valid_start.between(day_start,day_end))
+        day_end   = day_start + timedelta(days=1)
+        base += lambda s: s.where(models.Observation.valid_start >= day_start,
+                                  models.Observation.valid_start <  day_end)
+    base += lambda s: s.order_by(desc(models.Observation.valid_start)).limit(1)
 
-    old = (await db.scalars(base.order_by(desc(models.Observation.valid_start)).limit(1))).first()
+    old = (await db.scalars(base)).first()
     if not old: return []
 
     old.txn_end = delete_at
     await db.commit()
     return [old]
 
+# LOINC is seeded once at startup and never modified, so names are memoized
+# for the life of the process (misses included)
+LOINC_NAMES: dict = {}
+
 async def get_loinc_name(db: AsyncSession, loinc_code: str) -> Optional[str]:
+    if loinc_code in LOINC_NAMES:
+        return LOINC_NAMES[loinc_code]
     lo = (await db.scalars(
             select(models.Loinc).where(models.Loinc.loinc_num==loinc_code)
           )).first()
-    return lo.common_name if lo else None
+    name = LOINC_NAMES[loinc_code] = lo.common_name if lo else None
+    return name
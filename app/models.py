@@ -1,4 +1,4 @@
-from datetime import datetime
+from datetime import datetime, timezone
 from sqlalchemy import (
     Column,
     Integer,
@@ -7,10 +7,15 @@ from sqlalchemy import (
     DateTime,
     Float,
     ForeignKey,
+    Index,
 )
 from sqlalchemy.orm import relationship
 from app.database import Base
 
+def utcnow() -> datetime:
+    # naive UTC, matching the timezone-less DATETIME columns
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
 class Patient(Base):
     __tablename__ = "patients"
 
@@ -27,16 +32,40 @@ class Observation(Base):
     __tablename__ = "observations"
 
     obs_id      = Column(Integer, primary_key=True, index=True)
-    patient_id  = Column(Integer, ForeignKey("patients.patient_id"), nullable=False, index=True)
-    loinc_num   = Column(String, nullable=False, index=True)
+    patient_id  = Column(Integer, ForeignKey("patients.patient_id"), nullable=False)
+    loinc_num   = Column(String, nullable=False)
     value_num   = Column(Float, nullable=False)
     valid_start = Column(DateTime, nullable=False)
     valid_end   = Column(DateTime, nullable=True)
-    txn_start   = Column(DateTime, nullable=False, default=datetime.utcnow)
+    txn_start   = Column(DateTime, nullable=False, default=utcnow)
     txn_end     = Column(DateTime, nullable=True)
 
+    # integer copies of the VALID interval (microseconds since 1970-01-01) + day bin
+    valid_start_epoch = Column(Integer, nullable=False)
+    valid_end_epoch   = Column(Integer, nullable=True)
+    bin_id            = Column(Integer, nullable=False)
+
     patient = relationship("Patient", back_populates="observations")
 
+    __table_args__ = (
+        # history query: patient × LOINC × current txn, bounded by day bin and
+        # already in (bin_id, valid_start_epoch) order, so no sort is needed
+        Index("ix_obs_bin", patient_id, loinc_num, txn_end, bin_id, valid_start_epoch),
+        # retroactive delete: latest valid_start inside a day for patient × LOINC
+        Index("ix_obs_pid_loinc_vs", patient_id, loinc_num, valid_start.desc()),
+    )
+
+
+class ObsStats(Base):
+    """Per patient × LOINC VALID-time bounds, used to prune history queries."""
+    __tablename__ = "obs_stats"
+
+    patient_id            = Column(Integer, ForeignKey("patients.patient_id"), primary_key=True)
+    loinc_num             = Column(String, primary_key=True)
+    min_valid_start_epoch = Column(Integer, nullable=False)
+    # NULL while any observation of the pair has an open valid_end
+    max_valid_end_epoch   = Column(Integer, nullable=True)
+
 
 class Loinc(Base):
     __tablename__ = "loinc"
@@ -2,49 +2,113 @@
 
 import os
 import asyncio
+import threading
 import random
 import pandas as pd
 from faker import Faker
-from datetime import datetime
-from sqlalchemy import create_engine
+from datetime import datetime, timedelta
+from sqlalchemy import (
+    create_engine, event, select, insert, update, delete, bindparam, func, case, inspect,
+)
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.orm import sessionmaker
 
 from app.config import DATABASE_URL
-from app.database import Base, SessionLocal
-from app.models import Loinc
+from app.database import Base, SessionLocal, set_sqlite_pragmas
+from app.models import Loinc, Observation, ObsStats
 from app import crud, schemas
 
 # Sync
 sync_url    = DATABASE_URL.replace("sqlite+aiosqlite", "sqlite")
 sync_engine = create_engine(sync_url, future=True)
+if DATABASE_URL.startswith("sqlite"):
+    event.listen(sync_engine, "connect", set_sqlite_pragmas)
 SyncSession = sessionmaker(bind=sync_engine, autoflush=False, autocommit=False)
 Base.metadata.create_all(bind=sync_engine)
 
+# Schema upgrades (create_all never alters existing tables). The version is
+# kept in SQLite's PRAGMA user_version:
+#   0 – baseline, or epoch columns of unknown unit
+#   1 – VALID epochs in microseconds + bin_id, obs_stats maintained
+SCHEMA_VERSION = 1
+LEGACY_INDEXES = (
+    "ix_observations_patient_id", "ix_observations_loinc_num",
+    "ix_obs_hist", "ix_obs_valid_start",
+)
+
+def upgrade_schema():
+    with sync_engine.begin() as conn:
+        if conn.exec_driver_sql("PRAGMA user_version").scalar() >= SCHEMA_VERSION:
+            return
+        obs  = Observation.__table__
+        have = {c["name"] for c in inspect(conn).get_columns("observations")}
+        for col in ("valid_start_epoch", "valid_end_epoch", "bin_id"):
+            if col not in have:
+                conn.exec_driver_sql(f"ALTER TABLE observations ADD COLUMN {col} INTEGER")
+
+        # recompute from the DATETIME columns; exact, and also corrects any
+        # values stored in seconds by an earlier revision
+        rows = conn.execute(select(obs.c.obs_id, obs.c.valid_start, obs.c.valid_end)).all()
+        if rows:
+            conn.execute(
+                update(obs).where(obs.c.obs_id == bindparam("b_obs_id")),
+                [dict(b_obs_id=oid, **crud.temporal_cols(vs, ve)) for oid, vs, ve in rows]
+            )
+
+        for name in LEGACY_INDEXES:
+            conn.exec_driver_sql(f"DROP INDEX IF EXISTS {name}")
+        for ix in obs.indexes:
+            ix.create(conn, checkfirst=True)
+
+        # rebuild obs_stats from the (now exact) epochs
+        o = Observation
+        conn.execute(delete(ObsStats))
+        conn.execute(insert(ObsStats).from_select(
+            ["patient_id", "loinc_num", "min_valid_start_epoch", "max_valid_end_epoch"],
+            select(
+                o.patient_id,
+                o.loinc_num,
+                func.min(o.valid_start_epoch),
+                # NULL if any interval of the pair is open-ended
+                case((func.count() == func.count(o.valid_end_epoch),
+                      func.max(o.valid_end_epoch)))
+            ).group_by(o.patient_id, o.loinc_num)
+        ))
+        conn.exec_driver_sql(f"PRAGMA user_version = {SCHEMA_VERSION}")
+    if rows:
+        print(f"Upgraded {len(rows)} observations to schema v{SCHEMA_VERSION}.", flush=True)
+
+if DATABASE_URL.startswith("sqlite"):
+    upgrade_schema()
+
 # Grabs LOINC from CSV
 def seed_loinc_from_csv():
+    # O(1) existence probe instead of a full COUNT; also skips the CSV parse
+    with SyncSession() as db:
+        if db.scalar(select(Loinc.loinc_num).limit(1)) is not None:
+            print("LOINC already seeded, skipping.", flush=True)
+            return
+
     try:
         df = pd.read_csv(
             "data/L_TableCore.csv",
             usecols=["LOINC_NUM","LONG_COMMON_NAME"],
-            dtype=str
+            engine="pyarrow",
+            dtype_backend="pyarrow"
         ).dropna(subset=["LOINC_NUM","LONG_COMMON_NAME"])
     except Exception as e:
         print(f"Skipping LOINC seed ({e})", flush=True)
         return
 
-    with SyncSession() as db:
-        count = db.query(Loinc).count()
-        if count > 0:
-            print(f"LOINC already seeded ({count} rows), skipping.", flush=True)
-            return
+    # single executemany; OR IGNORE makes a repeated/overlapping seed a no-op
+    records = df.rename(columns={
+        "LOINC_NUM":        "loinc_num",
+        "LONG_COMMON_NAME": "common_name",
+    }).to_dict(orient="records")
 
     print(f"Seeding {len(df)} LOINC entries from CSV...", flush=True)
     with SyncSession() as db:
-        for _, r in df.iterrows():
-            db.merge(Loinc(
-                loinc_num   = r["LOINC_NUM"],
-                common_name = r["LONG_COMMON_NAME"]
-            ))
+        db.execute(sqlite_insert(Loinc).prefix_with("OR IGNORE"), records)
         db.commit()
     print("Local LOINC seeded.\n", flush=True)
 
@@ -55,35 +119,56 @@ DATE_IN  = "%d/%m/%Y %H:%M"
 DATE_BD  = "%d/%m/%Y"
 DATE_OUT = "%d/%m/%Y %H:%M"
 
-def safe_int(prompt: str) -> int:
+async def ainput(prompt: str) -> str:
+    # input() in a daemon thread so the event loop keeps running; unlike an
+    # executor thread it is never joined, so Ctrl-C / exit do not wait on it
+    loop = asyncio.get_running_loop()
+    fut  = loop.create_future()
+
+    def deliver(set_, value):
+        if not fut.done():
+            set_(value)
+
+    def read():
+        try:
+            line = input(prompt)
+        except BaseException as e:
+            loop.call_soon_threadsafe(deliver, fut.set_exception, e)
+        else:
+            loop.call_soon_threadsafe(deliver, fut.set_result, line)
+
+    threading.Thread(target=read, daemon=True).start()
+    return await fut
+
+async def safe_int(prompt: str) -> int:
     while True:
-        s = input(prompt)
+        s = await ainput(prompt)
         try:
             return int(s)
         except ValueError:
             print("Incorrect input – please enter a whole number.", flush=True)
 
-def safe_float(prompt: str) -> float:
+async def safe_float(prompt: str) -> float:
     while True:
-        s = input(prompt)
+        s = await ainput(prompt)
         try:
             return float(s)
         except ValueError:
             print("Incorrect input – please enter a numeric value.", flush=True)
 
-def safe_date(prompt: str) -> datetime.date:
+async def safe_date(prompt: str) -> datetime.date:
     while True:
-        s = input(prompt)
+        s = await ainput(prompt)
         try:
             return datetime.strptime(s, DATE_BD).date()
         except ValueError:
             print("Incorrect input – use format dd/mm/YYYY.", flush=True)
 
-def safe_datetime(prompt: str, allow_now: bool=False) -> datetime:
+async def safe_datetime(prompt: str, allow_now: bool=False) -> datetime:
     while True:
-        s = input(prompt)
+        s = await ainput(prompt)
         if allow_now and s.strip().lower() == "now":
-            return datetime.utcnow()
+            return crud.utcnow()
         try:
             return datetime.strptime(s, DATE_IN)
         except ValueError:
@@ -106,47 +191,44 @@ def print_menu():
     print("6. Create 10 NEW Fake Patients + Seed Observations from Excel", flush=True)
     print("7. Exit", flush=True)
 
-async def add_patient():
+async def add_patient(db):
     print("\n== Add Patient ==", flush=True)
-    first  = input("First name: ").strip()
-    last   = input("Last name : ").strip()
-    gender = input("Gender (M/F): ").strip().upper()
-    bd     = safe_date("Birth date (dd/mm/YYYY): ")
+    first  = (await ainput("First name: ")).strip()
+    last   = (await ainput("Last name : ")).strip()
+    gender = (await ainput("Gender (M/F): ")).strip().upper()
+    bd     = await safe_date("Birth date (dd/mm/YYYY): ")
     data   = schemas.PatientCreate(first_name=first, last_name=last, gender=gender, birth_date=bd)
-    async with SessionLocal() as db:
-        p = await crud.create_patient(db, data)
+    p = await crud.create_patient(db, data)
     print(f"Created patient ID={p.patient_id}", flush=True)
 
-async def add_observation():
+async def add_observation(db):
     print("\n== Add Observation ==", flush=True)
-    pid        = safe_int("Patient ID: ")
-    loinc      = input("LOINC Code: ").strip()
-    val        = safe_float("Value: ")
-    start      = safe_datetime("Start (dd/mm/YYYY HH:MM or now): ", allow_now=True)
-    end_input  = input("End (dd/mm/YYYY HH:MM or now, empty skip): ").strip()
+    pid        = await safe_int("Patient ID: ")
+    loinc      = (await ainput("LOINC Code: ")).strip()
+    val        = await safe_float("Value: ")
+    start      = await safe_datetime("Start (dd/mm/YYYY HH:MM or now): ", allow_now=True)
+    end_input  = (await ainput("End (dd/mm/YYYY HH:MM or now, empty skip): ")).strip()
     if end_input.lower() == "now":
-        end = datetime.utcnow()
+        end = crud.utcnow()
     elif not end_input:
         end = None
     else:
-        end = safe_datetime("End (dd/mm/YYYY HH:MM): ")
+        end = await safe_datetime("End (dd/mm/YYYY HH:MM): ")
     data = schemas.ObservationCreate(
         patient_id=pid, loinc_num=loinc,
         value_num=val, start=start, end=end
     )
-    async with SessionLocal() as db:
-        o = await crud.create_observation(db, data)
+    o = await crud.create_observation(db, data)
     print(f"Created observation ID={o.obs_id}", flush=True)
 
-async def show_history():
+async def show_history(db):
     print("\n== Observation History ==", flush=True)
-    pid   = safe_int("Patient ID: ")
-    loinc = input("LOINC Code: ").strip()
-    since = safe_datetime("Since (dd/mm/YYYY HH:MM or now): ", allow_now=True)
-    until = safe_datetime("Until (dd/mm/YYYY HH:MM or now): ", allow_now=True)
-    async with SessionLocal() as db:
-        name = await crud.get_loinc_name(db, loinc) or "(no name)"
-        hist = await crud.observations_history(db, pid, loinc, since, until)
+    pid   = await safe_int("Patient ID: ")
+    loinc = (await ainput("LOINC Code: ")).strip()
+    since = await safe_datetime("Since (dd/mm/YYYY HH:MM or now): ", allow_now=True)
+    until = await safe_datetime("Until (dd/mm/YYYY HH:MM or now): ", allow_now=True)
+    name = await crud.get_loinc_name(db, loinc) or "(no name)"
+    hist = await crud.observations_history(db, pid, loinc, since, until)
     if not hist:
         print("No results.", flush=True)
         return
@@ -159,15 +241,14 @@ async def show_history():
             flush=True
         )
 
-async def retro_update():
+async def retro_update(db):
     print("\n== Retroactive Update ==", flush=True)
-    name      = input("Patient full name (First Last): ").strip()
-    loinc     = input("LOINC Code: ").strip()
-    measured  = safe_datetime("Measured at (dd/mm/YYYY HH:MM or now): ", allow_now=True)
-    txn_at    = safe_datetime("Update at (dd/mm/YYYY HH:MM or now): ", allow_now=True)
-    new_val   = safe_float("New value: ")
-    async with SessionLocal() as db:
-        changed = await crud.retroactive_update(db, name, loinc, measured, txn_at, new_val)
+    name      = (await ainput("Patient full name (First Last): ")).strip()
+    loinc     = (await ainput("LOINC Code: ")).strip()
+    measured  = await safe_datetime("Measured at (dd/mm/YYYY HH:MM or now): ", allow_now=True)
+    txn_at    = await safe_datetime("Update at (dd/mm/YYYY HH:MM or now): ", allow_now=True)
+    new_val   = await safe_float("New value: ")
+    changed = await crud.retroactive_update(db, name, loinc, measured, txn_at, new_val)
     if not changed:
         print("No matching observation.", flush=True)
     else:
@@ -177,20 +258,19 @@ async def retro_update():
         print(f"[old] ID={old.obs_id} value={old.value_num} txn_end={fmt(old.txn_end)}", flush=True)
         print(f"[new] ID={new.obs_id} value={new.value_num} txn_start={fmt(new.txn_start)}", flush=True)
 
-async def retro_delete():
+async def retro_delete(db):
     print("\n== Retroactive Delete ==", flush=True)
-    name      = input("Patient full name (First Last): ").strip()
-    loinc     = input("LOINC Code: ").strip()
-    delete_at = safe_datetime("Delete at (dd/mm/YYYY HH:MM or now): ", allow_now=True)
-    meas_i    = input("Measured at (optional, dd/mm/YYYY HH:MM or now; empty): ").strip()
+    name      = (await ainput("Patient full name (First Last): ")).strip()
+    loinc     = (await ainput("LOINC Code: ")).strip()
+    delete_at = await safe_datetime("Delete at (dd/mm/YYYY HH:MM or now): ", allow_now=True)
+    meas_i    = (await ainput("Measured at (optional, dd/mm/YYYY HH:MM or now; empty): ")).strip()
     if meas_i.lower() == "now":
-        measured = datetime.utcnow()
+        measured = crud.utcnow()
     elif not meas_i:
         measured = None
     else:
-        measured = safe_datetime("Measured at (dd/mm/YYYY HH:MM): ")
-    async with SessionLocal() as db:
-        deleted = await crud.retroactive_delete(db, name, loinc, delete_at, measured)
+        measured = await safe_datetime("Measured at (dd/mm/YYYY HH:MM): ")
+    deleted = await crud.retroactive_delete(db, name, loinc, delete_at, measured)
     if not deleted:
         print("No matching observation.", flush=True)
     else:
@@ -200,7 +280,7 @@ async def retro_delete():
         print(f"Deleted ID={o.obs_id} value={o.value_num} txn_end={fmt(o.txn_end)}", flush=True)
 
 # 5) Create Fake Patients + Observations
-async def create_fake():
+async def create_fake(db):
     print("\n== Fake Patients + Seed Observations ==", flush=True)
 
     if not os.path.exists(PROJECT_DB_PATH):
@@ -208,7 +288,11 @@ async def create_fake():
         return
 
     try:
-        df = pd.read_excel(PROJECT_DB_PATH, engine="openpyxl")
+        df = pd.read_excel(
+            PROJECT_DB_PATH,
+            engine="calamine",
+            usecols=["LOINC-NUM","Value","Valid start time"]
+        )
     except Exception as e:
         print(f"Could not load '{PROJECT_DB_PATH}': {e}", flush=True)
         return
@@ -216,62 +300,86 @@ async def create_fake():
     # DEBUG
     print(f"DEBUG: loaded {len(df)} rows with columns: {df.columns.tolist()}", flush=True)
 
-    tests = df.to_dict("records")
+    # filter + convert the usable test rows once, column-wise, not per patient
+    # (match your actual column names exactly)
+    cols = ["LOINC-NUM", "Value", "Valid start time"]
+    df   = df.dropna(subset=cols)
+    df["LOINC-NUM"] = df["LOINC-NUM"].astype(str)
+
+    # guard against non‑numeric 'Value'
+    df["Value"] = pd.to_numeric(df["Value"], errors="coerce")
+    non_numeric = int(df["Value"].isna().sum())
+    if non_numeric:
+        print(f"  ⚠️ Skipping {non_numeric} rows with non-numeric values", flush=True)
+    df = df.dropna(subset=["Value"])
+
+    # calamine already yields datetimes for date cells; text falls back to DATE_IN
+    df["Valid start time"] = pd.to_datetime(df["Valid start time"], format=DATE_IN, errors="coerce")
+    bad_dates = int(df["Valid start time"].isna().sum())
+    if bad_dates:
+        print(f"  ⚠️ Skipping {bad_dates} rows with unparseable dates (expected dd/mm/YYYY HH:MM)", flush=True)
+    df = df.dropna(subset=["Valid start time"])
+
+    valid_tests = [
+        (code, float(num), start.to_pydatetime())
+        for code, num, start in df[cols].itertuples(index=False, name=None)
+    ]
 
     created_patients     = []
     created_observations = []
 
-    async with SessionLocal() as db:
-        for gender in ("M", "F"):
-            for _ in range(5):
-                # 1) create patient
-                pdata = schemas.PatientCreate(
-                    first_name = (fake.first_name_male() if gender=="M" else fake.first_name_female()),
-                    last_name  = fake.last_name(),
-                    gender     = gender,
-                    birth_date = fake.date_of_birth(minimum_age=20, maximum_age=80)
-                )
-                patient = await crud.create_patient(db, pdata)
-                created_patients.append((
-                    patient.patient_id,
-                    patient.first_name,
-                    patient.last_name,
-                    patient.gender
-                ))
-
-                # 2) pick up to 3 random test rows
-                for t in random.sample(tests, min(3, len(tests))):
-                    # match your actual column names exactly
-                    code = t.get("LOINC-NUM")
-                    val  = t.get("Value")
-                    dt   = t.get("Valid start time")
-
-                    # 3) skip incomplete rows
-                    if pd.isna(code) or pd.isna(val) or pd.isna(dt):
-                        continue
-
-                    # guard against non‑numeric 'Value'
-                    try:
-                        num = float(val)
-                    except (ValueError, TypeError):
-                        print(f"  ⚠️ Skipping non-numeric value {val!r}", flush=True)
-                        continue
-
-                    start = pd.to_datetime(dt)
-                    odata = schemas.ObservationCreate(
-                        patient_id = patient.patient_id,
-                        loinc_num  = str(code),
-                        value_num  = num,
-                        start      = start,
-                        end        = start + pd.Timedelta(minutes=1)
-                    )
-                    obs = await crud.create_observation(db, odata)
-                    created_observations.append((
-                        obs.obs_id,
-                        obs.patient_id,
-                        obs.loinc_num,
-                        obs.value_num
-                    ))
+    # generate the Faker values once, then index into the pools
+    first_pool = {
+        "M": [fake.first_name_male()   for _ in range(5)],
+        "F": [fake.first_name_female() for _ in range(5)],
+    }
+    last_pool = [fake.last_name() for _ in range(10)]
+    bd_pool   = [fake.date_of_birth(minimum_age=20, maximum_age=80) for _ in range(10)]
+
+    pdatas = [
+        schemas.PatientCreate(
+            first_name = first_pool[gender][i],
+            last_name  = last_pool[g * 5 + i],
+            gender     = gender,
+            birth_date = bd_pool[g * 5 + i]
+        )
+        for g, gender in enumerate(("M", "F")) for i in range(5)
+    ]
+
+    # patients + observations go in one transaction: a single commit at the end
+    now = crud.utcnow()
+    # 1) create all patients in one batch (ids needed for the FK below)
+    patients = await crud.create_patients(db, pdatas, commit=False)
+    for patient in patients:
+        created_patients.append((
+            patient.patient_id,
+            patient.first_name,
+            patient.last_name,
+            patient.gender
+        ))
+
+    odatas = []
+    for patient in patients:
+        # 2) pick up to 3 random valid test rows
+        for code, num, start in random.sample(valid_tests, min(3, len(valid_tests))):
+            odatas.append(schemas.ObservationCreate(
+                patient_id = patient.patient_id,
+                loinc_num  = code,
+                value_num  = num,
+                start      = start,
+                end        = start + timedelta(minutes=1)
+            ))
+
+    # 4) insert all observations in one batch
+    obs_ids = await crud.create_observations(db, odatas, commit=False, now=now)
+    await db.commit()
+    for obs_id, obs in zip(obs_ids, odatas):
+        created_observations.append((
+            obs_id,
+            obs.patient_id,
+            obs.loinc_num,
+            obs.value_num
+        ))
 
     # summary
     print("\nPatients created:", flush=True)
@@ -283,18 +391,30 @@ async def create_fake():
         print(f"  • ObsID={oid}  PatientID={pid}  LOINC={lo}  Value={val}", flush=True)
 
 async def main():
-    while True:
-        print_menu()
-        choice = input("Choose: ").strip()
-        if   choice == "1": await add_patient()
-        elif choice == "2": await add_observation()
-        elif choice == "3": await show_history()
-        elif choice == "4": await retro_update()
-        elif choice == "5": await retro_delete()
-        elif choice == "6": await create_fake()
-        elif choice == "7": break
-        else:
-            print("Invalid choice, please try again.", flush=True)
+    # one session (and aiosqlite connection) for the whole CLI run
+    async with SessionLocal() as db:
+        while True:
+            print_menu()
+            choice = (await ainput("Choose: ")).strip()
+            try:
+                if   choice == "1": await add_patient(db)
+                elif choice == "2": await add_observation(db)
+                elif choice == "3": await show_history(db)
+                elif choice == "4": await retro_update(db)
+                elif choice == "5": await retro_delete(db)
+                elif choice == "6": await create_fake(db)
+                elif choice == "7": break
+                else:
+                    print("Invalid choice, please try again.", flush=True)
+            except EOFError:
+                raise
+            except Exception as e:
+                await db.rollback()
+                print(f"Operation failed: {e}", flush=True)
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    # Ctrl-C / Ctrl-D at any prompt ends the CLI
+    try:
+        asyncio.run(main())
+    except (KeyboardInterrupt, EOFError):
+        print(flush=True)